@@ -0,0 +1,34 @@
+"""add carbonmonoxide (timestamp, geom) gist index
+
+Revision ID: 5d0f3c8e21a7
+Revises: b3ae57ee07d4
+Create Date: 2026-10-15 09:48:02.907115+00:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5d0f3c8e21a7'
+down_revision = 'b3ae57ee07d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Required for including the timestamp in a GiST index
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    # Build the index without locking the table against writes
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_carbonmonoxide_timestamp_geom'),
+                        'carbonmonoxide', ['timestamp', 'geom'], unique=False,
+                        postgresql_using='gist',
+                        postgresql_concurrently=True)
+    op.execute('ANALYZE carbonmonoxide')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_carbonmonoxide_timestamp_geom'),
+                      table_name='carbonmonoxide',
+                      postgresql_concurrently=True)
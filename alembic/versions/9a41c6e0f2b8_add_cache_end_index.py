@@ -0,0 +1,28 @@
+"""add cache.end index
+
+Revision ID: 9a41c6e0f2b8
+Revises: 5d0f3c8e21a7
+Create Date: 2026-10-15 14:02:37.519804+00:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9a41c6e0f2b8'
+down_revision = '5d0f3c8e21a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Build the index without locking the table against writes
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_cache_end'), 'cache', ['end'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_cache_end'), table_name='cache',
+                      postgresql_concurrently=True)
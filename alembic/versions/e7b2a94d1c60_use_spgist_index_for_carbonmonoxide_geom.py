@@ -0,0 +1,37 @@
+"""use sp-gist index for carbonmonoxide.geom
+
+Revision ID: e7b2a94d1c60
+Revises: 9a41c6e0f2b8
+Create Date: 2026-10-15 13:27:51.640218+00:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b2a94d1c60'
+down_revision = '9a41c6e0f2b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Build the new index before dropping the old one, both without locking
+    # the table against writes
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_carbonmonoxide_geom'),
+                        'carbonmonoxide', ['geom'], unique=False,
+                        postgresql_using='spgist',
+                        postgresql_concurrently=True)
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS idx_carbonmonoxide_geom')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('idx_carbonmonoxide_geom',
+                        'carbonmonoxide', ['geom'], unique=False,
+                        postgresql_using='gist',
+                        postgresql_concurrently=True)
+        op.drop_index(op.f('ix_carbonmonoxide_geom'),
+                      table_name='carbonmonoxide',
+                      postgresql_concurrently=True)
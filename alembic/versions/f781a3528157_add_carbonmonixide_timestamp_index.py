@@ -16,10 +16,15 @@ depends_on = None
 
 
 def upgrade():
-    op.create_index(op.f('ix_carbonmonoxide_timestamp'),
-                    'carbonmonoxide', ['timestamp'], unique=False)
+    # Build the index without locking the table against writes
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_carbonmonoxide_timestamp'),
+                        'carbonmonoxide', ['timestamp'], unique=False,
+                        postgresql_concurrently=True)
 
 
 def downgrade():
-    op.drop_index(op.f('ix_carbonmonoxide_timestamp'),
-                  table_name='carbonmonoxide')
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_carbonmonoxide_timestamp'),
+                      table_name='carbonmonoxide',
+                      postgresql_concurrently=True)
@@ -17,14 +17,32 @@ logger = logging.getLogger(__name__)
 # Number of workers
 workers = config('workers') or 1
 
-# Earliest data to process
-earliest_data = datetime.datetime.fromisoformat(
-    config('earliest_data') or '2019-01-01')
-# Latest data to process
-latest_data = (
-    datetime.datetime.fromisoformat(config('latest_data')) if config(
-        'latest_data') else datetime.datetime.now()
-)
+# Directory worker processes download files to. Set by init_worker.
+working_directory = None
+
+
+def get_earliest_data():
+    '''Get the earliest date of data to process from the configuration.
+    The configuration is only parsed when the value is needed, so importing
+    this module does not fail on invalid dates.
+
+    :return: Earliest date to process, defaults to 2019-01-01.
+    :rtype: datetime.datetime
+    '''
+    return datetime.datetime.fromisoformat(
+        config('earliest_data') or '2019-01-01')
+
+
+def get_latest_data():
+    '''Get the latest date of data to process from the configuration.
+
+    :return: Latest date to process, defaults to the current time.
+    :rtype: datetime.datetime
+    '''
+    latest_data = config('latest_data')
+    if latest_data:
+        return datetime.datetime.fromisoformat(latest_data)
+    return datetime.datetime.now()
 
 
 def generate_intervals(start, end, days=5):
@@ -59,6 +77,9 @@ def get_intervals_to_process(session, table, exclude_existing=True):
     :return: Generator yielding the next interval.
     :rtype: generator
     '''
+    earliest_data = get_earliest_data()
+    latest_data = get_latest_data()
+
     # Ignore the existing data and return the full interval
     if not exclude_existing:
         return generate_intervals(earliest_data, latest_data)
@@ -86,12 +107,33 @@ def get_intervals_to_process(session, table, exclude_existing=True):
 
 
 @db.with_session
-def single_file_update(session, product_file, directory, product):
-    '''Download a single file, add it to the database
-    and delete the file afterwards.
+def filter_processed_files(session, product_files):
+    '''Remove all already processed files from a list of product files.
+    Existing files are looked up using a single query.
 
     :param session: SQLAlchemy Session
     :type session: sqlalchemy.orm.session.Session
+    :param product_files: Metadata of product files
+                          as received from sentinal5dl.search.
+    :type product_files: list
+    :return: Metadata of all product files not yet processed.
+    :rtype: list
+    '''
+    filenames = [f'{product_file["identifier"]}.nc'
+                 for product_file in product_files]
+    processed = {filename for filename, in session.query(db.File.filename)
+                 .filter(db.File.filename.in_(filenames))}
+    if processed:
+        logger.info('Skipping %d already processed files', len(processed))
+    return [product_file
+            for product_file, filename in zip(product_files, filenames)
+            if filename not in processed]
+
+
+def single_file_update(product_file, directory, product):
+    '''Download a single file, add it to the database
+    and delete the file afterwards.
+
     :param product_file: Metadata of a single product file
                          as received from sentinal5dl.search.
     :type product_file: dict
@@ -103,12 +145,6 @@ def single_file_update(session, product_file, directory, product):
     '''
     filename = f'{product_file["identifier"]}.nc'
 
-    # Check if file already processed.
-    if session.query(db.File)\
-            .filter(db.File.filename == filename).first():
-        logger.warning('File %s already processed', filename)
-        return
-
     # Download file.
     logger.info('Downloading file %s', filename)
     sentinel5dl.download((product_file,), directory)
@@ -123,6 +159,32 @@ def single_file_update(session, product_file, directory, product):
     os.remove(filepath)
 
 
+def init_worker(directory):
+    '''Initialize a worker process.
+    Clear session maker in fork, due to libpq, and set the directory to
+    download files to once instead of passing it along with every file.
+
+    :param directory: Directory to download files to.
+    :type directory: string
+    '''
+    global working_directory
+    db.__session__ = None
+    working_directory = directory
+
+
+def import_product_file(args):
+    '''Worker function importing a single product file.
+    Only the product name is passed to the worker to avoid pickling the
+    product's table definition for every file.
+
+    :param args: Tuple of the product name and the product file metadata
+                 as received from sentinal5dl.search.
+    :type args: tuple
+    '''
+    name, product_file = args
+    single_file_update(product_file, working_directory, db.products[name])
+
+
 def main():
     '''Entrypoint for running this as a module or from the binary.
     Triggers the autoupdater.
@@ -137,15 +199,16 @@ def main():
         '--ignore-existing', action='store_true',
         help='Ignore the already downloaded intervals.'
         'This is useful to fill the gaps between already downloaded data.')
+    parser.add_argument(
+        '--cluster', action='store_true',
+        help='Reorder the product tables by time and location after the '
+        'update. This locks the tables while they are rewritten.')
     args = parser.parse_args()
 
-    def init_worker():
-        '''Clear session maker in fork, due to libpq
-        '''
-        db.__session__ = None
-
-    # Generate temporary directory to work in.
-    with tempfile.TemporaryDirectory() as tmp_dir:
+    # Generate temporary directory to work in and start the worker processes
+    # once for all products and intervals to avoid forking them repeatedly.
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            multiprocessing.Pool(workers, init_worker, (tmp_dir,)) as pool:
         # Iterate through products and import data not already present.
         for name, product in db.products.items():
             logger.info('Updating product %s', name)
@@ -162,7 +225,8 @@ def main():
                     processing_mode='Offline', processing_level='L2',
                     product=product['product_key'],
                 )
-                product_files = result.get('products', [])
+                product_files = filter_processed_files(
+                    result.get('products', []))
 
                 # update active imports
                 with db.get_session() as session:
@@ -177,12 +241,10 @@ def main():
                     logger.info(
                         'Processing product files in parallel with %d workers',
                         workers)
-                    with multiprocessing.Pool(workers, init_worker) as p:
-                        p.starmap(
-                            single_file_update,
-                            zip(product_files, itertools.repeat(tmp_dir),
-                                itertools.repeat(product))
-                        )
+                    for _ in pool.imap_unordered(
+                            import_product_file,
+                            zip(itertools.repeat(name), product_files)):
+                        pass
                 finally:
                     # reset active imports
                     with db.get_session() as session:
@@ -191,6 +253,10 @@ def main():
                                               'active_imports',
                                               name,
                                               0)
+            if args.cluster:
+                with db.get_session() as session:
+                    with session.begin():
+                        db.cluster_table(session, product['table'])
             logger.info('Finished updating product %s', name)
     logger.info('Update complete')
 
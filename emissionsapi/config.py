@@ -6,6 +6,7 @@
 Load and handle Emissions API configuration.
 '''
 
+import functools
 import logging
 import os
 import yaml
@@ -13,9 +14,10 @@ import yaml
 # Logger
 logger = logging.getLogger(__name__)
 
-__config = {}
+__config = None
 
 
+@functools.lru_cache(maxsize=1)
 def configuration_file():
     '''Find the best match for the configuration file.  The configuration file
     locations taken into consideration are (in this particular order):
@@ -24,6 +26,8 @@ def configuration_file():
     - ``~/emissionsapi.yml``
     - ``/etc/emissionsapi.yml``
 
+    The lookup is done only once and its result is cached afterwards.
+
     :return: configuration file name or None
     '''
     if os.path.isfile('./emissionsapi.yml'):
@@ -40,14 +44,19 @@ def update_configuration():
     '''
     cfgfile = configuration_file()
     if not cfgfile:
+        globals()['__config'] = {}
         return {}
     with open(cfgfile, 'r') as f:
-        cfg = yaml.safe_load(f)
+        cfg = yaml.safe_load(f) or {}
     globals()['__config'] = cfg
 
     # update logger
-    loglevel = cfg.get('loglevel', 'INFO').upper()
-    logging.root.setLevel(loglevel)
+    loglevel = str(cfg.get('loglevel', 'INFO')).upper()
+    level = logging.getLevelName(loglevel)
+    if not isinstance(level, int):
+        logger.warning('Invalid log level %s, using INFO instead', loglevel)
+        loglevel, level = 'INFO', logging.INFO
+    logging.root.setLevel(level)
     logger.info('Log level set to %s', loglevel)
 
     return cfg
@@ -61,7 +70,7 @@ def config(*args):
     :type key: string
     :return: dictionary containing the configuration or configuration value
     '''
-    cfg = __config or update_configuration()
+    cfg = __config if __config is not None else update_configuration()
     for key in args:
         if cfg is None:
             return
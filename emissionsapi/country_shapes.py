@@ -36,28 +36,29 @@ def __load_country_shapes__():
             logger.warning('Unable to find %s', country['name'])
             continue
 
-        # Save geometry as wkt string with both alpha 2 and 3 code as key.
-        shape = country['geometry']
+        # Save geometry as hex encoded WKB with both alpha 2 and 3 code as
+        # key. Unlike WKT, PostGIS can read this without parsing text.
+        shape = country['geometry'].wkb_hex
         __country_shapes__[country_codes.alpha2] = shape
         __country_shapes__[country_codes.alpha3] = shape
         __country_names__[country_codes.alpha2] = country['name']
         __country_names__[country_codes.alpha3] = country['name']
 
 
-def get_country_wkt(country):
-    '''Get wkt for country.
+def get_country_geom(country):
+    '''Get geometry for country.
 
     :param country: alpha 2 or 3 country code.
     :type country: str
     :raises CountryNotFound: Country is not found in the country codes.
-    :return: WKT defining the country.
+    :return: Hex encoded WKB defining the country.
     :rtype: str
     '''
     if not __country_shapes__:
         __load_country_shapes__()
 
     try:
-        return __country_shapes__[country].wkt
+        return __country_shapes__[country]
     except KeyError:
         raise CountryNotFound
 
@@ -6,16 +6,19 @@
 """
 
 from functools import wraps
+import io
 import logging
+import multiprocessing
+import struct
 
 import sqlalchemy
 from sqlalchemy import and_, or_, create_engine, Column, DateTime, Float, \
     String, PickleType
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
-import pandas
-import psycopg2.extensions
+import numpy
 import geoalchemy2
 
 from emissionsapi.config import config
@@ -42,17 +45,41 @@ products = config('products') or {
 # H3 Resolution
 resolution = config('resolution') or 4
 
+# Create missing tables and indexes when connecting to the database
+create_tables = config('create_tables') is not False
+
 # Global session variable. Set on initialization.
 __session__ = None
 
+# Binary layout of a little-endian WKB point
+wkb_point = numpy.dtype([
+    ('byte_order', 'u1'),
+    ('geometry_type', '<u4'),
+    ('longitude', '<f8'),
+    ('latitude', '<f8')])
+
+# Binary layout of a row in PostgreSQL's binary COPY format
+copy_row = numpy.dtype([
+    ('field_count', '>i2'),
+    ('value_length', '>i4'),
+    ('value', '>f8'),
+    ('timestamp_length', '>i4'),
+    ('timestamp', '>i8'),
+    ('geom_length', '>i4'),
+    ('geom', wkb_point)])
+
+# Signature, flags and header extension length of the binary COPY format
+copy_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+
+# End of data marker of the binary COPY format
+copy_trailer = struct.pack('>h', -1)
+
+# PostgreSQL stores timestamps as microseconds since 2000-01-01
+postgres_epoch = numpy.datetime64('2000-01-01', 'us')
+
 # Base Class of all ORM objects.
 Base = declarative_base()
 
-# Add psycopg2 adapter for pandas Series
-psycopg2.extensions.register_adapter(
-    pandas.core.series.Series,
-    lambda arr: psycopg2.extensions.adapt(list(arr)))
-
 
 class AlembicVersion(Base):
     __tablename__ = 'alembic_version'
@@ -119,9 +146,10 @@ class Cache(Base):
     """Begin of the time interval involved in this request (used for
     efficiently invalidating caches)
     """
-    end = Column(DateTime)
+    end = Column(DateTime, index=True)
     """End of the time interval involved in this request (used for efficiently
-    invalidating caches)
+    invalidating caches). Indexed since imports usually only affect the most
+    recent data, so few cached responses end after the imported data begins.
     """
     response = Column(PickleType)
     """Cached response"""
@@ -152,44 +180,50 @@ class Cache(Base):
         session.commit()
 
 
+# The btree_gist extension is required for indexing the timestamp and
+# geometry of measurements in a combined GiST index
+sqlalchemy.event.listen(
+    Base.metadata, 'before_create',
+    sqlalchemy.DDL('CREATE EXTENSION IF NOT EXISTS btree_gist'))
+
 for name, attributes in products.items():
     attributes['table'] = sqlalchemy.Table(
         name, Base.metadata,
         Column('value', Float),
         Column('timestamp', DateTime, index=True),
-        Column('geom', geoalchemy2.Geometry(geometry_type='POINT')))
+        Column('geom', geoalchemy2.Geometry(geometry_type='POINT',
+                                            spatial_index=False)),
+        # Points never overlap, which makes SP-GiST a smaller and faster
+        # spatial index than the GiST index created by GeoAlchemy2.
+        sqlalchemy.Index(f'ix_{name}_geom', 'geom',
+                         postgresql_using='spgist'),
+        # Combined index for queries filtering by time and location
+        sqlalchemy.Index(f'ix_{name}_timestamp_geom', 'timestamp', 'geom',
+                         postgresql_using='gist'))
 
 
 def with_session(f):
-    """Wrapper for f to make a SQLAlchemy session present within the function
+    """Wrapper for f to make a SQLAlchemy session present within the function.
+    The session is closed once f returns or raises an exception, rolling back
+    everything which has not been committed.
 
     :param f: Function to call
     :type f: Function
-    :raises e: Possible exception of f
     :return: Result of f
     """
     @wraps(f)
     def decorated(*args, **kwargs):
-        # Get new session
-        session = get_session()
-        try:
-            # Call f with the session and all the other arguments
-            result = f(session, *args, **kwargs)
-        except Exception as e:
-            # Rollback session, something bad happend.
-            session.rollback()
-            session.close()
-            raise e
-        # Close session and return the result of f
-        session.close()
-        return result
+        # Call f with a new session and all the other arguments
+        with get_session() as session:
+            return f(session, *args, **kwargs)
     return decorated
 
 
 def get_session():
     """Get a new session.
 
-    Lazy load the database connection and create the tables.
+    Lazy load the database connection and create the tables unless this is
+    disabled in the configuration.
 
     Returns:
         sqlalchemy.orm.session.Session -- SQLAlchemy Session object
@@ -197,37 +231,80 @@ def get_session():
     global __session__
     # Create database connection, tables and Sessionmaker if neccessary.
     if not __session__:
+        if multiprocessing.current_process().name == 'MainProcess':
+            # Recycle connections before the server may close them and
+            # check them before use so that requests never fail on stale
+            # connections from the pool.
+            pool_options = {'pool_recycle': 3600, 'pool_pre_ping': True}
+        else:
+            # Worker processes use one session at a time and must never
+            # reuse connections inherited from their parent process.
+            pool_options = {'poolclass': NullPool}
         Engine = create_engine(
-            database, echo=logger.getEffectiveLevel() == logging.DEBUG)
+            database, echo=logger.getEffectiveLevel() == logging.DEBUG,
+            **pool_options)
         __session__ = sessionmaker(bind=Engine)
-        Base.metadata.create_all(Engine)
+        if create_tables:
+            Base.metadata.create_all(Engine)
 
     # Return new session object
     return __session__()
 
 
-def insert_dataset(session, data, tbl):
-    '''Batch insert data into the database using PostGIS specific functions.
+def insert_dataset(session, data, tbl, page_size=5000):
+    '''Batch insert data into the database using PostgreSQL's binary COPY.
+    Values and timestamps are sent in their binary representation and
+    geometries as WKB, so PostgreSQL does not need to parse any text.
+
+    Data is serialized and sent in pages to limit the size of the in-memory
+    buffer for large files. All pages are part of the same transaction.
 
     :param session: SQLAlchemy Session
     :type session: sqlalchemy.orm.session.Session
     :param data: DataFrame containing value, timestamp, longitude and latitude
     :type data: pandas.core.frame.DataFrame
-    :param tbl: Base class representing the database table for the data
-    :type tbl: sqlalchemy.ext.declarative.api.DeclarativeMeta
+    :param tbl: Table to write data to
+    :type tbl: sqlalchemy.sql.schema.Table
+    :param page_size: Number of rows to send per COPY, defaults to 5000
+    :type page_size: int, optional
     '''
-    values = sqlalchemy.select([sqlalchemy.func.unnest(data.value),
-                                sqlalchemy.func.unnest(data.timestamp),
-                                sqlalchemy.func.ST_MakePoint(
-                                    sqlalchemy.func.unnest(data.longitude),
-                                    sqlalchemy.func.unnest(data.latitude))])
-    query = sqlalchemy.insert(tbl).from_select(tbl.columns, values)
-    session.execute(query)
+    query = f'COPY {tbl.name} (value, timestamp, geom) FROM STDIN ' \
+        '(FORMAT binary)'
+    values = numpy.asarray(data.value)
+    timestamps = (numpy.asarray(data.timestamp, dtype='datetime64[us]')
+                  - postgres_epoch).astype('int64')
+    longitudes = numpy.asarray(data.longitude)
+    latitudes = numpy.asarray(data.latitude)
+    buf = io.BytesIO()
+    with session.connection().connection.cursor() as cursor:
+        for start in range(0, len(data), page_size):
+            end = start + page_size
+            rows = numpy.empty(len(values[start:end]), dtype=copy_row)
+            rows['field_count'] = 3
+            rows['value_length'] = 8
+            rows['value'] = values[start:end]
+            rows['timestamp_length'] = 8
+            rows['timestamp'] = timestamps[start:end]
+            rows['geom_length'] = wkb_point.itemsize
+            rows['geom']['byte_order'] = 1
+            rows['geom']['geometry_type'] = 1
+            rows['geom']['longitude'] = longitudes[start:end]
+            rows['geom']['latitude'] = latitudes[start:end]
+            buf.seek(0)
+            buf.truncate()
+            buf.write(copy_header)
+            buf.write(rows)
+            buf.write(copy_trailer)
+            buf.seek(0)
+            cursor.copy_expert(query, buf)
 
 
 def get_points(session, tbl):
     """Get all points.
 
+    Results are fetched in batches using a server-side cursor to avoid loading
+    large numbers of points into memory at once.
+
     :param session: SQLAlchemy Session
     :type session: sqlalchemy.orm.session.Session
     :param tbl: Table to get data from
@@ -240,7 +317,7 @@ def get_points(session, tbl):
         tbl.c.value,
         tbl.c.timestamp,
         tbl.c.geom.ST_X(),
-        tbl.c.geom.ST_Y())
+        tbl.c.geom.ST_Y()).yield_per(10000)
 
 
 def get_averages(session, tbl):
@@ -310,10 +387,12 @@ def filter_query(query, tbl, wkt=None, distance=None, begin=None, end=None):
     :type query: sqlalchemy.orm.Query
     :param tbl: Table to get data from
     :type tbl: sqlalchemy.sql.schema.Table
-    :param wkt: WKT Element specifying an area in which to search for points,
-                defaults to None.
-    :type wkt: geoalchemy2.WKTElement, optional
+    :param wkt: WKT or hex encoded WKB specifying an area in which to search
+                for points, defaults to None.
+    :type wkt: str, optional
     :param distance: Distance as defined in PostGIS' ST_DWithin_ function.
+                     Points are stored as plain longitude/latitude
+                     coordinates, so the distance is given in degrees.
     :type distance: float, optional
     :param begin: Get only points after this timestamp, defaults to None
     :type begin: datetime.datetime, optional
@@ -324,13 +403,14 @@ def filter_query(query, tbl, wkt=None, distance=None, begin=None, end=None):
 
     .. _ST_DWithin: https://postgis.net/docs/ST_DWithin.html
     """
-    # Filter by WKT
+    # Filter by WKT. The geometry column is compared directly, without any
+    # casts, so that the spatial indexes can be used.
     if wkt is not None:
         if distance is not None:
-            query = query.filter(geoalchemy2.func.ST_DWITHIN(
+            query = query.filter(sqlalchemy.func.ST_DWithin(
                 tbl.c.geom, wkt, distance))
         else:
-            query = query.filter(geoalchemy2.func.ST_WITHIN(
+            query = query.filter(sqlalchemy.func.ST_Within(
                 tbl.c.geom, wkt))
 
     # Filter for points after the time specified as begin
@@ -381,3 +461,22 @@ def get_data_range(session, tbl):
     return session.query(
         sqlalchemy.func.min(tbl.c.timestamp),
         sqlalchemy.func.max(tbl.c.timestamp))
+
+
+def cluster_table(session, tbl):
+    """Physically reorder the rows of a table according to the combined
+    timestamp and geometry index. This puts measurements close in time and
+    space into the same pages, reducing the pages read by area and time
+    filtered queries.
+
+    Note that this locks the table exclusively while it is being rewritten.
+
+    :param session: SQLAlchemy Session
+    :type session: sqlalchemy.orm.session.Session
+    :param tbl: Table to cluster
+    :type tbl: sqlalchemy.sql.schema.Table
+    """
+    logger.info('Clustering table %s', tbl.name)
+    session.execute(sqlalchemy.text(
+        f'CLUSTER {tbl.name} USING ix_{tbl.name}_timestamp_geom'))
+    session.execute(sqlalchemy.text(f'ANALYZE {tbl.name}'))
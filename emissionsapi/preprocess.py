@@ -11,6 +11,7 @@ import multiprocessing
 import os
 
 import s5a
+import sqlalchemy
 
 from emissionsapi.config import config
 import emissionsapi.db
@@ -54,6 +55,11 @@ def list_ncfiles(session, storage):
 def write_to_database(session, data, filepath, tbl):
     """Write data to the PostGIS database
 
+    The transaction is committed asynchronously, without waiting for the
+    write-ahead log to be flushed to disk. A crash may lose the most recent
+    imports, but since the file is recorded in the same transaction, lost
+    files are imported again by the next run.
+
     :param session: SQLAlchemy Session
     :type session: sqlalchemy.orm.session.Session
     :param tbl: Table to to write data to
@@ -65,6 +71,9 @@ def write_to_database(session, data, filepath, tbl):
     :param tbl: Table to to write data to
     :type tbl: sqlalchemy.sql.schema.Table
     """
+    # Do not wait for the write-ahead log to be flushed on commit
+    session.execute(sqlalchemy.text('SET LOCAL synchronous_commit = OFF'))
+
     # Insert data
     emissionsapi.db.insert_dataset(session, data, tbl)
 
@@ -114,24 +123,39 @@ def preprocess_file(ncfile, tbl, product):
     logger.info("Finished writing points from '%s' to database", ncfile)
 
 
+def preprocess_product_file(args):
+    '''Worker function preprocessing a single file of a product.
+    Only the product name is passed to the worker to avoid pickling the
+    product's table definition for every file.
+
+    :param args: Tuple of the product name and the path to the ncfile
+    :type args: tuple
+    '''
+    name, ncfile = args
+    attributes = emissionsapi.db.products[name]
+    preprocess_file(ncfile, attributes['table'], attributes.get('product'))
+
+
 def main():
     """Entrypoint for running this as a module or from the binary.
     Triggers the preprocessing of the data.
     """
 
-    for name, attributes in emissionsapi.db.products.items():
-        logger.info('Preprocessing product %s', name)
-
-        def init():
-            # Clear session maker in fork, due to libpq
-            emissionsapi.db.__session__ = None
-
-        # Iterate through all nc files
-        with multiprocessing.Pool(workers, init) as p:
-            p.starmap(preprocess_file, zip(
-                sorted(list_ncfiles(attributes['storage'])),
-                itertools.repeat(attributes['table']),
-                itertools.repeat(attributes.get('product'))))
+    def init():
+        # Clear session maker in fork, due to libpq
+        emissionsapi.db.__session__ = None
+
+    # Use the same worker processes for all products
+    with multiprocessing.Pool(workers, init) as p:
+        for name, attributes in emissionsapi.db.products.items():
+            logger.info('Preprocessing product %s', name)
+
+            # Iterate through all nc files, handing each free worker the
+            # next file as soon as it has finished the previous one
+            for _ in p.imap_unordered(preprocess_product_file, zip(
+                    itertools.repeat(name),
+                    sorted(list_ncfiles(attributes['storage'])))):
+                pass
 
     logger.info('Finished database import')
 
@@ -42,10 +42,6 @@ def polygon_to_wkt(polygon):
         raise RESTParamError('At least 4 points are needed to define a '
                              'polygon')
 
-    # create list with x-y points as strings
-    points = []
-    for index in range(0, len(polygon), 2):
-        points.append(f'{polygon[index]} {polygon[index+1]}')
-
-    # return string with points, joined by ','
-    return f'POLYGON(({",".join(points)}))'
+    # create x-y points as strings and join them by ','
+    points = ','.join(f'{x} {y}' for x, y in zip(polygon[::2], polygon[1::2]))
+    return f'POLYGON(({points}))'
@@ -6,20 +6,24 @@
 the users.
 """
 from functools import wraps
+import datetime
 import dateutil.parser
+import hashlib
 import hmac
+import itertools
 import logging
 import os.path
 
 import connexion
 import json
-from flask import redirect, request, jsonify, make_response
+from flask import redirect, request, make_response, Response
 from h3 import h3
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy.dialects import postgresql
 
 import emissionsapi.db
 from emissionsapi.config import config
-from emissionsapi.country_shapes import CountryNotFound, get_country_wkt
+from emissionsapi.country_shapes import CountryNotFound, get_country_geom
 from emissionsapi.country_shapes import get_country_codes  # noqa - used in API
 from emissionsapi.utils import bounding_box_to_wkt, polygon_to_wkt, \
     RESTParamError
@@ -83,6 +87,24 @@ def request_counter(f):
     return wrapper
 
 
+def parse_datetime(date):
+    """Parse a date string. ISO 8601 dates are parsed directly while other
+    formats fall back to the more lenient but much slower dateutil parser.
+
+    :param date: Date string to parse
+    :type date: str
+    :raises ValueError: Invalid date string
+    :return: Parsed date
+    :rtype: datetime.datetime
+    """
+    # Python < 3.11 does not accept a trailing Z as UTC designator
+    iso_date = date[:-1] + '+00:00' if date.endswith('Z') else date
+    try:
+        return datetime.datetime.fromisoformat(iso_date)
+    except ValueError:
+        return dateutil.parser.parse(date)
+
+
 def parse_date(*keys):
     """Function wrapper replacing string date arguments with
     datetime.datetime
@@ -101,7 +123,7 @@ def parse_date(*keys):
                 if date is None:
                     continue
                 try:
-                    kwargs[key] = dateutil.parser.parse(date)
+                    kwargs[key] = parse_datetime(date)
                 except ValueError:
                     return f'Invalid {key}', 400
             return function(*args, **kwargs)
@@ -110,8 +132,8 @@ def parse_date(*keys):
 
 
 def parse_wkt(f):
-    """Function wrapper replacing 'geoframe', 'country' and 'polygon' with a
-    WKT polygon.
+    """Function wrapper replacing 'geoframe', 'country', 'polygon' and
+    'point' with a WKT or hex encoded WKB geometry passed as 'wkt'.
 
     :param f: Function to call
     :type f: Function
@@ -142,7 +164,7 @@ def parse_wkt(f):
         elif country is not None:
             logger.debug('Try parsing country')
             try:
-                kwargs['wkt'] = get_country_wkt(country.upper())
+                kwargs['wkt'] = get_country_geom(country.upper())
             except CountryNotFound:
                 return 'Unknown country code.', 400
         # parse parameter polygon
@@ -198,20 +220,24 @@ def cache_with_session(function):
         begin = kwargs.get('begin')
         end = kwargs.get('end')
 
-        # construct a primary key for this request
-        req = json.dumps((request.path, request.args), sort_keys=True)
-        for cache in session.query(emissionsapi.db.Cache)\
-                            .filter(emissionsapi.db.Cache.request == req):
+        # construct a fixed-length primary key for this request
+        req = hashlib.blake2b(
+            json.dumps((request.path, request.args), sort_keys=True).encode(),
+            digest_size=16).hexdigest()
+        cache = session.get(emissionsapi.db.Cache, req)
+        if cache is not None:
             logger.debug('Using cache')
             return cache.response
 
-        # not in cache, put in cache
+        # not in cache, put in cache unless a concurrent request for the same
+        # data has already done so
         result = function(session, *args, **kwargs)
-        session.add(emissionsapi.db.Cache(
-            request=req,
-            begin=begin,
-            end=end,
-            response=result))
+        session.execute(postgresql.insert(emissionsapi.db.Cache)
+                        .values(request=req,
+                                begin=begin,
+                                end=end,
+                                response=result)
+                        .on_conflict_do_nothing())
         session.commit()
         return result
     return wrapper
@@ -221,14 +247,19 @@ def cache_with_session(function):
 @get_table
 @parse_wkt
 @parse_date('begin', 'end')
-@emissionsapi.db.with_session
-def get_geo_data(session, wkt=None, distance=None, begin=None, end=None,
-                 limit=None, offset=None, tbl=None, **kwargs):
+def get_geo_data(wkt=None, distance=None, begin=None, end=None, limit=None,
+                 offset=None, tbl=None, **kwargs):
     """Get data in GeoJSON format.
 
-    :param session: SQLAlchemy session
-    :type session: sqlalchemy.orm.session.Session
-    :param wkt: Well-known text representation of geometry, defaults to None.
+    The feature collection is streamed in batches of features while the points
+    are fetched from the database, so that large collections are never held in
+    memory at once. The query is run and the first batch is fetched before the
+    response is returned, so that database errors still result in an error
+    response. Note that a pooled database connection and an open transaction
+    stay checked out until the client has downloaded the whole stream.
+
+    :param wkt: WKT or hex encoded WKB specifying an area in which to search
+                for points, defaults to None.
 
     :type wkt: string, optional
     :param distance: Distance as defined in PostGIS' ST_DWithin_ function.
@@ -243,21 +274,22 @@ def get_geo_data(session, wkt=None, distance=None, begin=None, end=None,
     :param tbl: Table to get data from, defaults to None
     :type tbl: sqlalchemy.sql.schema.Table, optional
     :return: Feature Collection with requested Points
-    :rtype: geojson.FeatureCollection
+    :rtype: flask.Response
 
     .. _ST_DWithin: https://postgis.net/docs/ST_DWithin.html
     """
-    # Iterate through database query
-    query = emissionsapi.db.get_points(session, tbl)
-    # Filter result
-    query = emissionsapi.db.filter_query(
-        query, tbl, wkt=wkt, distance=distance, begin=begin, end=end)
-    # Apply limit and offset
-    query = emissionsapi.db.limit_offset_query(
-        query, limit=limit, offset=offset)
-
-    return jsonify({
-        'features': [{
+    session = emissionsapi.db.get_session()
+    try:
+        # Iterate through database query
+        query = emissionsapi.db.get_points(session, tbl)
+        # Filter result
+        query = emissionsapi.db.filter_query(
+            query, tbl, wkt=wkt, distance=distance, begin=begin, end=end)
+        # Apply limit and offset
+        query = emissionsapi.db.limit_offset_query(
+            query, limit=limit, offset=offset)
+
+        features = (json.dumps({
             'geometry': {
                 'coordinates': [longitude, latitude],
                 'type': 'Point',
@@ -267,9 +299,28 @@ def get_geo_data(session, wkt=None, distance=None, begin=None, end=None,
                 'value': value,
             },
             'type': 'Feature'
-        } for value, timestamp, longitude, latitude in query],
-        "type": "FeatureCollection"
-    })
+        }) for value, timestamp, longitude, latitude in query)
+
+        # Run the query before sending anything to the client
+        batch = ','.join(itertools.islice(features, 1000))
+    except Exception:
+        session.close()
+        raise
+
+    def generate(batch):
+        yield '{"features":['
+        # Send features in batches to avoid writing tiny chunks
+        separator = ''
+        while batch:
+            yield separator + batch
+            separator = ','
+            batch = ','.join(itertools.islice(features, 1000))
+        yield '],"type":"FeatureCollection"}'
+
+    response = Response(generate(batch), mimetype='application/json')
+    # Close the session once the response is finished or aborted
+    response.call_on_close(session.close)
+    return response
 
 
 @request_counter
@@ -282,7 +333,8 @@ def get_average(session, wkt=None, distance=None, begin=None, end=None,
 
     :param session: SQLAlchemy session
     :type session: sqlalchemy.orm.session.Session
-    :param wkt: Well-known text representation of geometry, defaults to None.
+    :param wkt: WKT or hex encoded WKB specifying an area in which to search
+                for points, defaults to None.
     :type wkt: string, optional
     :param distance: Distance as defined in PostGIS' ST_DWithin_ function.
     :type distance: float, optional
@@ -335,7 +387,8 @@ def get_statistics(session, interval='day', wkt=None, distance=None,
                      aggregated as accepted by PostgreSQL's date_trunc_
                      function like ``day`` or ``week``.
     :type interval: str
-    :param wkt: Well-known text representation of geometry, defaults to None.
+    :param wkt: WKT or hex encoded WKB specifying an area in which to search
+                for points, defaults to None.
     :type wkt: string, optional
     :param distance: Distance as defined in PostGIS' ST_DWithin_ function.
     :type distance: float, optional
@@ -429,6 +482,24 @@ app.add_api(os.path.join(os.path.abspath(
 application = app.app
 
 
+@application.after_request
+def conditional_response(response):
+    """Add an ETag to complete responses and reply with 304 Not Modified if
+    the client already has the current version of a response.
+
+    :param response: Response to send
+    :type response: flask.Response
+    :return: Possibly modified response
+    :rtype: flask.Response
+    """
+    # Streamed responses are never read into memory to compute an ETag
+    if request.method == 'GET' and response.status_code == 200 \
+            and not response.is_streamed:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
 @app.route('/metrics')
 def prometheus_metrics():
     '''Return metrics in OpenMetrics format for Prometheus.